@@ -5,36 +5,25 @@ Complete agent loop with tool execution framework
 """
 
 import os
-import json
-import anthropic
-from typing import Dict, List, Any, Optional
+import re
+import codecs
+import asyncio
+import hashlib
+import itertools
+import collections
+import orjson
+import msgspec
+from typing import Dict, List, Any, Optional, Tuple, Literal, Iterable, Annotated
 from datetime import datetime
 import subprocess
-import docker
 
+try:
+    import uvloop
+except ImportError:  # uvloop does not support Windows
+    uvloop = None
 
-class ManusAgent:
-    """
-    Main agent class implementing the Manus 1.5 architecture
-    """
-    
-    def __init__(self, api_key: str):
-        self.client = anthropic.Anthropic(api_key=api_key)
-        self.model = "claude-3-5-sonnet-20241022"
-        self.max_tokens = 8192
-        self.conversation_history = []
-        self.current_plan = None
-        self.error_count = 0
-        self.max_errors = 3
-        
-        # Initialize Docker client for sandbox
-        self.docker_client = docker.from_env()
-        
-    def get_system_prompt(self) -> str:
-        """
-        Return the complete Manus system prompt
-        """
-        return """You are Manus, an autonomous general AI agent capable of completing complex tasks through iterative tool use and strategic planning.
+
+SYSTEM_PROMPT = """You are Manus, an autonomous general AI agent capable of completing complex tasks through iterative tool use and strategic planning.
 
 You operate in a sandboxed virtual machine environment with internet access, allowing you to:
 * Leverage a clean, isolated workspace that prevents interference and enforces security
@@ -57,7 +46,8 @@ You are operating in an *agent loop*, iteratively completing tasks through these
 <tool_use>
 - MUST respond with function calling (tool use); direct text responses are forbidden
 - MUST follow instructions in tool descriptions for proper usage
-- MUST respond with exactly one tool call per response; parallel calling is forbidden
+- MAY call several independent tools in one response; they run concurrently
+- NEVER batch tool calls where one depends on the result of another
 - NEVER mention specific tool names in user-facing messages
 </tool_use>
 
@@ -83,8 +73,8 @@ You are operating in an *agent loop*, iteratively completing tasks through these
 </communication>
 
 <execution>
-- Execute exactly one tool per iteration
-- Wait for tool results before next action
+- Batch independent tool calls into a single response
+- Wait for tool results before any action that depends on them
 - Learn from errors and adapt strategies
 - Max 3 retry attempts before escalating to user
 - Save important findings to files immediately
@@ -109,175 +99,658 @@ You are operating in an *agent loop*, iteratively completing tasks through these
 - Never repeat the same failed action
 - After 3 failures, explain to user and request guidance
 </error_handling>
+"""
 
-The current date is {current_date}.
+SYSTEM_CONTEXT_TEMPLATE = """The current date is {current_date}.
 The default working language is English.
-""".format(current_date=datetime.now().strftime("%b %d, %Y"))
+"""
 
-    def get_tools(self) -> List[Dict[str, Any]]:
-        """
-        Define all available tools for function calling
-        """
-        return [
-            {
-                "name": "plan",
-                "description": "Create, update, and advance the structured task plan",
-                "input_schema": {
-                    "type": "object",
-                    "properties": {
-                        "action": {
-                            "type": "string",
-                            "enum": ["update", "advance"],
-                            "description": "The action to perform"
-                        },
-                        "goal": {
-                            "type": "string",
-                            "description": "The overall goal of the task"
-                        },
-                        "current_phase_id": {
-                            "type": "integer",
-                            "description": "ID of the current phase"
-                        },
-                        "next_phase_id": {
-                            "type": "integer",
-                            "description": "ID of the next phase (for advance action)"
-                        },
-                        "phases": {
-                            "type": "array",
-                            "description": "List of phases",
-                            "items": {
-                                "type": "object",
-                                "properties": {
-                                    "id": {"type": "integer"},
-                                    "title": {"type": "string"},
-                                    "capabilities": {"type": "object"}
-                                }
-                            }
+# The cached system block is a single constant so every request sends a
+# byte-identical prefix; the context template is pre-split around the date
+SYSTEM_PROMPT_BLOCK = {"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}
+SYSTEM_CONTEXT_PREFIX, SYSTEM_CONTEXT_SUFFIX = SYSTEM_CONTEXT_TEMPLATE.split("{current_date}")
+
+# Shell output beyond this many bytes is cut to its head and tail
+SHELL_OUTPUT_LIMIT = 8 * 1024
+
+# Seconds a shell command may outlive its in-sandbox timeout before the
+# agent stops waiting on its output stream
+SHELL_TIMEOUT_GRACE = 5
+
+# Default page size for file reads (kept small so one page stays a small
+# fraction of the history token budget) and chunk size for file writes
+FILE_READ_LENGTH = 32 * 1024
+FILE_CHUNK_SIZE = 1024 * 1024
+
+# Largest file page or shell output a single tool call may request, which
+# bounds the size of the turns kept verbatim in the history
+TOOL_RESULT_LIMIT = 2 * FILE_READ_LENGTH
+
+# Number of idempotent tool results kept in the response cache
+RESULT_CACHE_SIZE = 64
+
+SUMMARY_PROMPT = """You condense the working history of an autonomous agent.
+
+Summarize the transcript you are given so the agent can continue its task without it. Preserve:
+* The current plan, completed phases, and the phase in progress
+* Files created or modified, with their paths
+* Commands run and the key facts learned from their output
+* Errors encountered and how they were resolved
+* Any answers or preferences given by the user
+
+Be concise and factual. Do not invent steps that are not in the transcript.
+"""
+
+TOOLS = (
+    {
+        "name": "plan",
+        "description": "Create, update, and advance the structured task plan",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "action": {
+                    "type": "string",
+                    "enum": ["update", "advance"],
+                    "description": "The action to perform"
+                },
+                "goal": {
+                    "type": "string",
+                    "description": "The overall goal of the task"
+                },
+                "current_phase_id": {
+                    "type": "integer",
+                    "description": "ID of the current phase"
+                },
+                "next_phase_id": {
+                    "type": "integer",
+                    "description": "ID of the next phase (for advance action)"
+                },
+                "phases": {
+                    "type": "array",
+                    "description": "List of phases",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "id": {"type": "integer"},
+                            "title": {"type": "string"},
+                            "capabilities": {"type": "object"}
                         }
-                    },
-                    "required": ["action", "current_phase_id"]
+                    }
                 }
             },
-            {
-                "name": "message",
-                "description": "Send messages to interact with the user",
-                "input_schema": {
-                    "type": "object",
-                    "properties": {
-                        "type": {
-                            "type": "string",
-                            "enum": ["info", "ask", "result"],
-                            "description": "The type of message"
-                        },
-                        "text": {
-                            "type": "string",
-                            "description": "The message text"
-                        },
-                        "attachments": {
-                            "type": "array",
-                            "description": "List of file paths to attach",
-                            "items": {"type": "string"}
-                        }
-                    },
-                    "required": ["type", "text"]
+            "required": ["action", "current_phase_id"]
+        }
+    },
+    {
+        "name": "message",
+        "description": "Send messages to interact with the user",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "type": {
+                    "type": "string",
+                    "enum": ["info", "ask", "result"],
+                    "description": "The type of message"
+                },
+                "text": {
+                    "type": "string",
+                    "description": "The message text"
+                },
+                "attachments": {
+                    "type": "array",
+                    "description": "List of file paths to attach",
+                    "items": {"type": "string"}
                 }
             },
-            {
-                "name": "shell",
-                "description": "Execute shell commands in sandbox environment",
-                "input_schema": {
-                    "type": "object",
-                    "properties": {
-                        "action": {
-                            "type": "string",
-                            "enum": ["exec", "view"],
-                            "description": "The action to perform"
-                        },
-                        "command": {
-                            "type": "string",
-                            "description": "The shell command to execute"
-                        },
-                        "session": {
-                            "type": "string",
-                            "description": "Session identifier"
-                        },
-                        "timeout": {
-                            "type": "integer",
-                            "description": "Timeout in seconds",
-                            "default": 30
-                        }
-                    },
-                    "required": ["action", "session"]
+            "required": ["type", "text"]
+        }
+    },
+    {
+        "name": "shell",
+        "description": "Execute shell commands in sandbox environment",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "action": {
+                    "type": "string",
+                    "enum": ["exec", "view"],
+                    "description": "The action to perform"
+                },
+                "command": {
+                    "type": "string",
+                    "description": "The shell command to execute",
+                    "default": ""
+                },
+                "session": {
+                    "type": "string",
+                    "description": "Session identifier"
+                },
+                "timeout": {
+                    "type": "integer",
+                    "description": "Timeout in seconds",
+                    "default": 30,
+                    "minimum": 1
+                },
+                "max_output_bytes": {
+                    "type": "integer",
+                    "description": "Maximum bytes of output to return; longer output keeps its head and tail",
+                    "default": SHELL_OUTPUT_LIMIT,
+                    "minimum": 1,
+                    "maximum": TOOL_RESULT_LIMIT
                 }
             },
-            {
-                "name": "file",
-                "description": "Perform operations on files",
-                "input_schema": {
-                    "type": "object",
-                    "properties": {
-                        "action": {
-                            "type": "string",
-                            "enum": ["read", "write", "append", "edit"],
-                            "description": "The action to perform"
+            "required": ["action", "session"]
+        }
+    },
+    {
+        "name": "file",
+        "description": "Perform operations on files",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "action": {
+                    "type": "string",
+                    "enum": ["read", "write", "append", "edit"],
+                    "description": "The action to perform"
+                },
+                "path": {
+                    "type": "string",
+                    "description": "Absolute file path"
+                },
+                "text": {
+                    "type": "string",
+                    "description": "Content to write or append",
+                    "default": ""
+                },
+                "offset": {
+                    "type": "integer",
+                    "description": "Byte offset to start reading from (for read action)",
+                    "default": 0,
+                    "minimum": 0
+                },
+                "length": {
+                    "type": "integer",
+                    "description": "Maximum number of bytes to read (for read action); continue from next_offset to page through larger files",
+                    "default": FILE_READ_LENGTH,
+                    # Room for one whole UTF-8 character, so every page
+                    # advances next_offset
+                    "minimum": 4,
+                    "maximum": TOOL_RESULT_LIMIT
+                },
+                "edits": {
+                    "type": "array",
+                    "description": "List of edits to make",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "find": {"type": "string"},
+                            "replace": {"type": "string"}
                         },
-                        "path": {
-                            "type": "string",
-                            "description": "Absolute file path"
-                        },
-                        "text": {
-                            "type": "string",
-                            "description": "Content to write or append"
-                        },
-                        "edits": {
-                            "type": "array",
-                            "description": "List of edits to make",
-                            "items": {
-                                "type": "object",
-                                "properties": {
-                                    "find": {"type": "string"},
-                                    "replace": {"type": "string"}
-                                }
-                            }
-                        }
-                    },
-                    "required": ["action", "path"]
+                        "required": ["find", "replace"]
+                    }
                 }
-            }
+            },
+            "required": ["action", "path"]
+        },
+        # Breakpoint on the last tool caches the whole tool schema
+        "cache_control": {"type": "ephemeral"}
+    }
+)
+
+JSON_SCHEMA_TYPES = {"string": str, "integer": int, "number": float, "boolean": bool}
+
+
+def schema_type(name: str, schema: Dict[str, Any]) -> Any:
+    """
+    Map a JSON schema to the equivalent msgspec type annotation
+    """
+    if "enum" in schema:
+        return Literal[tuple(schema["enum"])]
+    if schema["type"] == "array":
+        return List[schema_type(name, schema["items"])]
+    if schema["type"] == "object":
+        if "properties" in schema:
+            return schema_struct(name, schema)
+        return Dict[str, Any]
+    if "minimum" in schema or "maximum" in schema:
+        return Annotated[
+            JSON_SCHEMA_TYPES[schema["type"]],
+            msgspec.Meta(ge=schema.get("minimum"), le=schema.get("maximum"))
         ]
+    return JSON_SCHEMA_TYPES[schema["type"]]
+
+
+def schema_struct(name: str, schema: Dict[str, Any]) -> type:
+    """
+    Synthesize a msgspec.Struct that validates objects matching an object schema.
+
+    Required properties have no default; optional ones take the schema
+    default, an empty list for arrays, or None.
+    """
+    required = set(schema.get("required", ()))
+    fields = []
+    for prop, prop_schema in schema["properties"].items():
+        field_type = schema_type(name + prop.title(), prop_schema)
+        if prop in required:
+            fields.append((prop, field_type))
+        elif "default" in prop_schema:
+            fields.append((prop, field_type, prop_schema["default"]))
+        elif prop_schema["type"] == "array":
+            fields.append((prop, field_type, []))
+        else:
+            fields.append((prop, Optional[field_type], None))
+    return msgspec.defstruct(name, fields, kw_only=True, omit_defaults=True)
+
+
+# Typed tool inputs, generated once from the tool schemas above
+TOOL_INPUTS = {
+    tool["name"]: schema_struct(f"{tool['name'].title()}Input", tool["input_schema"])
+    for tool in TOOLS
+}
+PlanInput = TOOL_INPUTS["plan"]
+MessageInput = TOOL_INPUTS["message"]
+ShellInput = TOOL_INPUTS["shell"]
+FileInput = TOOL_INPUTS["file"]
+
+
+class ToolStatus(msgspec.Struct):
+    """
+    Status field of a JSON tool result; other fields are skipped on decode
+    """
+    status: str = ""
+
+
+TOOL_STATUS_DECODER = msgspec.json.Decoder(ToolStatus)
+
+def to_json(obj: Any) -> str:
+    """
+    Serialize a tool result to a JSON string using orjson
+    """
+    return orjson.dumps(obj, default=msgspec.to_builtins).decode()
+
+
+class OutputCapture:
+    """
+    Bounded capture of a command's output stream.
+
+    Keeps the first and last limit/2 bytes and counts everything in between,
+    so memory stays constant however much the command prints.
+    """
+    
+    def __init__(self, limit: int = SHELL_OUTPUT_LIMIT):
+        # The tail window must hold at least one byte for the trimming loop
+        limit = max(limit, 2)
+        self.head_limit = limit // 2
+        self.tail_limit = limit - self.head_limit
+        self.head = bytearray()
+        self.tail = collections.deque()
+        self.tail_size = 0
+        self.total = 0
+    
+    def feed(self, data: bytes):
+        self.total += len(data)
+        if len(self.head) < self.head_limit:
+            take = self.head_limit - len(self.head)
+            self.head += data[:take]
+            data = data[take:]
+        if data:
+            self.tail.append(data)
+            self.tail_size += len(data)
+            # Drop whole chunks that fall entirely outside the tail window
+            while self.tail_size - len(self.tail[0]) >= self.tail_limit:
+                self.tail_size -= len(self.tail.popleft())
+    
+    @property
+    def truncated(self) -> bool:
+        return self.total > len(self.head) + self.tail_limit
+    
+    def getvalue(self) -> str:
+        tail = b"".join(self.tail)[-self.tail_limit:]
+        if not self.truncated:
+            return (bytes(self.head) + tail).decode(errors="replace")
+        elided = self.total - len(self.head) - len(tail)
+        return (
+            bytes(self.head).decode(errors="replace")
+            + f"\n...[elided {elided} bytes]...\n"
+            + tail.decode(errors="replace")
+        )
+
+
+def format_transcript(messages: Iterable[Dict[str, Any]]) -> str:
+    """
+    Render conversation messages as plain text for summarization
+    """
+    lines = []
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        for block in content:
+            if block["type"] == "text":
+                lines.append(f"[{message['role']}] {block['text']}")
+            elif block["type"] == "tool_use":
+                lines.append(f"[tool call] {block['name']} {to_json(block['input'])}")
+            elif block["type"] == "tool_result":
+                lines.append(f"[tool result] {block['content']}")
+    return "\n\n".join(lines)
+
+
+def resolve_path(path: str) -> str:
+    """
+    Return the canonical absolute form of a file path
+    """
+    return os.path.realpath(os.path.abspath(path))
+
+
+def stat_file(path: str) -> Tuple[str, os.stat_result]:
+    """
+    Return the resolved path and stat result for a file
+    """
+    path = resolve_path(path)
+    return path, os.stat(path)
+
+
+def write_chunked(f, text: str):
+    """
+    Write text in fixed-size chunks so it is never encoded in one piece
+    """
+    for start in range(0, len(text), FILE_CHUNK_SIZE):
+        f.write(text[start:start + FILE_CHUNK_SIZE])
+
+
+def apply_edits(content: str, edits: List[msgspec.Struct]) -> Tuple[str, List[str]]:
+    """
+    Apply find/replace edits to content in a single pass.
+
+    A single edit uses str.replace directly. Several are combined into one
+    capturing alternation regex, longest first so overlapping patterns
+    prefer the most specific match; splitting on it puts every match at an
+    odd index, so replacements are mapped and joined without a per-match
+    Python callback. Returns the new content and warnings for edits that
+    were skipped.
+    """
+    replacements = {}
+    warnings = []
+    for edit in edits:
+        find = edit.find
+        if not find:
+            warnings.append("Empty find string ignored")
+        elif find in replacements:
+            warnings.append(f"Duplicate find string ignored: {find!r}")
+        else:
+            replacements[find] = edit.replace
     
-    def execute_tool(self, tool_name: str, tool_input: Dict[str, Any]) -> str:
+    if len(replacements) == 1:
+        # No per-match Python callback needed for a single pattern
+        (find, replace), = replacements.items()
+        content = content.replace(find, replace)
+    elif replacements:
+        pattern = re.compile("(" + "|".join(
+            re.escape(find) for find in sorted(replacements, key=len, reverse=True)
+        ) + ")")
+        parts = pattern.split(content)
+        parts[1::2] = map(replacements.__getitem__, parts[1::2])
+        content = "".join(parts)
+    
+    return content, warnings
+
+
+class ManusAgent:
+    """
+    Main agent class implementing the Manus 1.5 architecture
+    """
+    
+    def __init__(self, api_key: str, prewarm_sandbox: bool = True):
+        # Imported here rather than at module load to keep script start-up fast
+        import anthropic
+        
+        self.client = anthropic.AsyncAnthropic(api_key=api_key)
+        self.model = "claude-3-5-sonnet-20241022"
+        self.max_tokens = 8192
+        self.conversation_history = collections.deque()
+        self.current_plan = None
+        self.error_count = 0
+        self.max_errors = 3
+        
+        # Older turns are summarized once the prompt exceeds this many tokens
+        # or the stored history this many serialized bytes; up to
+        # keep_recent_turns of the latest turns that fit in half of each
+        # budget are kept verbatim
+        self.history_token_budget = 60000
+        self.history_byte_budget = 16 * FILE_READ_LENGTH
+        self.keep_recent_turns = 4
+        self.history_tokens = 0
+        self.history_bytes = 0
+        self.task = None
+        
+        # Shared Docker client and long-lived sandbox container that every
+        # shell command execs into; both are created in start(), eagerly in
+        # the background when prewarm_sandbox is set, otherwise on first use
+        self.prewarm_sandbox = prewarm_sandbox
+        self.docker = None
+        self.sandbox = None
+        self._sandbox_task = None
+        self.shell_sessions = {}
+
+        # Build the prompt and tool schema once instead of every iteration
+        self._system_prompt = self.get_system_prompt()
+        self._tools = self.get_tools()
+        
+        # Directories already created by file writes
+        self._ensured_dirs = set()
+        
+        # LRU cache of idempotent tool results
+        self._result_cache = collections.OrderedDict()
+        
+        # Tool name -> (bound handler, typed input decoder)
+        self._dispatch = {
+            "plan": (self.execute_plan, msgspec.json.Decoder(TOOL_INPUTS["plan"])),
+            "message": (self.execute_message, msgspec.json.Decoder(TOOL_INPUTS["message"])),
+            "shell": (self.execute_shell, msgspec.json.Decoder(TOOL_INPUTS["shell"])),
+            "file": (self.execute_file, msgspec.json.Decoder(TOOL_INPUTS["file"]))
+        }
+        
+    async def start(self):
         """
-        Execute a tool and return the result
+        Connect to the Docker daemon and start the sandbox container
         """
+        if self.docker is None:
+            # Deferred so tasks that never touch the sandbox skip the import
+            import aiodocker
+            
+            self.docker = aiodocker.Docker()
+        if self.sandbox is None:
+            self.sandbox = await self.docker.containers.run(config={
+                "Image": "ubuntu:22.04",
+                "Cmd": ["sleep", "infinity"],
+                "HostConfig": {
+                    "Memory": 512 * 1024 * 1024,
+                    "CpuQuota": 100000,
+                    "NetworkMode": "bridge"
+                }
+            })
+        return self.sandbox
+    
+    def warm_sandbox(self):
+        """
+        Start the sandbox in the background so it boots while Claude is
+        still producing the first response
+        """
+        if self._sandbox_task is None:
+            self._sandbox_task = asyncio.create_task(self.start())
+    
+    async def get_sandbox(self):
+        """
+        Return the running sandbox container, waiting for warm-up if needed
+        """
+        self.warm_sandbox()
         try:
-            if tool_name == "plan":
-                return self.execute_plan(tool_input)
-            elif tool_name == "message":
-                return self.execute_message(tool_input)
-            elif tool_name == "shell":
-                return self.execute_shell(tool_input)
-            elif tool_name == "file":
-                return self.execute_file(tool_input)
-            else:
+            return await self._sandbox_task
+        except Exception:
+            # Allow the next shell call to retry a failed start
+            self._sandbox_task = None
+            raise
+    
+    async def close(self):
+        """
+        Remove the sandbox container and close the Docker connection
+        """
+        if self._sandbox_task is not None:
+            # Let an in-flight start finish so its container is not leaked
+            await asyncio.gather(self._sandbox_task, return_exceptions=True)
+            self._sandbox_task = None
+        if self.sandbox is not None:
+            await self.sandbox.delete(force=True)
+            self.sandbox = None
+        if self.docker is not None:
+            await self.docker.close()
+            self.docker = None
+    
+    async def __aenter__(self):
+        if self.prewarm_sandbox:
+            self.warm_sandbox()
+        return self
+    
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+        
+    def get_system_prompt(self) -> List[Dict[str, Any]]:
+        """
+        Return the complete Manus system prompt as cacheable content blocks.
+
+        The static instructions carry a cache breakpoint so the prefix is
+        reused across iterations; the date lives in a trailing uncached
+        block so it never invalidates the cache.
+        """
+        current_date = datetime.now().strftime("%b %d, %Y")
+        return [
+            SYSTEM_PROMPT_BLOCK,
+            {"type": "text", "text": SYSTEM_CONTEXT_PREFIX + current_date + SYSTEM_CONTEXT_SUFFIX}
+        ]
+
+    def get_tools(self) -> Tuple[Dict[str, Any], ...]:
+        """
+        Define all available tools for function calling
+        """
+        return TOOLS
+    
+    async def execute_tool(self, tool_name: str, tool_input: str) -> str:
+        """
+        Validate the raw JSON tool input, execute the tool and return the result
+        """
+        try:
+            if tool_name not in self._dispatch:
                 return f"Error: Unknown tool '{tool_name}'"
+            handler, decoder = self._dispatch[tool_name]
+            params = decoder.decode(tool_input)
+            
+            key = await self.get_cache_key(tool_name, params)
+            if key is not None and key in self._result_cache:
+                self._result_cache.move_to_end(key)
+                return self._result_cache[key]
+            
+            result = await handler(params)
+            
+            # Our own modifications may keep the inode, size and (on coarse
+            # timestamp filesystems) mtime, so drop cached reads explicitly
+            if isinstance(params, FileInput) and params.action != "read":
+                path = await asyncio.to_thread(resolve_path, params.path)
+                self.evict_cached_reads(path)
+            
+            # Errors may clear without touching the keyed stat fields (e.g. a
+            # permission fix only changes ctime), so only successes are kept
+            if key is not None and TOOL_STATUS_DECODER.decode(result).status == "success":
+                self._result_cache[key] = result
+                if len(self._result_cache) > RESULT_CACHE_SIZE:
+                    self._result_cache.popitem(last=False)
+            return result
         except Exception as e:
             self.error_count += 1
             return f"Error executing {tool_name}: {str(e)}"
     
-    def execute_plan(self, params: Dict[str, Any]) -> str:
+    async def get_resource_key(self, tool_name: str, tool_input: Dict[str, Any]) -> str:
+        """
+        Return the resource a tool call touches; calls sharing a resource
+        within one response are executed in order
+        """
+        if tool_name == "file" and isinstance(tool_input.get("path"), str):
+            # Different spellings of one path must map to the same resource;
+            # resolving walks the path, so it runs off the event loop
+            path = tool_input["path"]
+            try:
+                path = await asyncio.to_thread(resolve_path, path)
+            except (OSError, ValueError):
+                pass
+            return f"file:{path}"
+        if tool_name == "shell":
+            return f"shell:{tool_input.get('session')}"
+        return tool_name
+    
+    async def execute_after(
+        self,
+        resource: asyncio.Future,
+        earlier: List[Tuple[asyncio.Future, asyncio.Task]],
+        tool_name: str,
+        tool_input: str
+    ) -> str:
+        """
+        Execute a tool once the latest earlier call in the response on the
+        same resource finishes
+        """
+        # Resource keys resolve concurrently, but the predecessor is always
+        # picked from the calls dispatched before this one
+        key = await resource
+        previous = None
+        for other, task in earlier:
+            if await other == key:
+                previous = task
+        if previous is not None:
+            await asyncio.wait([previous])
+        return await self.execute_tool(tool_name, tool_input)
+    
+    async def get_cache_key(self, tool_name: str, params: msgspec.Struct) -> Optional[tuple]:
+        """
+        Return a response-cache key for side-effect-free tool calls, or None.
+
+        Only file reads qualify; the key includes the resolved path and the
+        file's inode, mtime and size so external changes invalidate it. Plan
+        actions mutate the current plan and are never cached.
+        """
+        if not isinstance(params, FileInput) or params.action != "read":
+            return None
+        try:
+            path, stat = await asyncio.to_thread(stat_file, params.path)
+        except OSError:
+            return None
+        return (
+            tool_name,
+            path,
+            msgspec.json.encode(params),
+            stat.st_ino,
+            stat.st_mtime_ns,
+            stat.st_size
+        )
+    
+    def evict_cached_reads(self, path: str):
+        """
+        Drop every cached read result for a resolved file path
+        """
+        for key in [key for key in self._result_cache if key[1] == path]:
+            del self._result_cache[key]
+    
+    async def execute_plan(self, params: PlanInput) -> str:
         """
         Handle task planning
         """
-        action = params.get("action")
+        action = params.action
         
         if action == "update":
             self.current_plan = {
-                "goal": params.get("goal"),
-                "phases": params.get("phases", []),
-                "current_phase_id": params.get("current_phase_id")
+                "goal": params.goal,
+                "phases": params.phases,
+                "current_phase_id": params.current_phase_id
             }
-            return json.dumps({
+            return to_json({
                 "status": "success",
                 "message": "Task plan updated",
                 "plan": self.current_plan
@@ -285,23 +758,23 @@ The default working language is English.
         
         elif action == "advance":
             if self.current_plan:
-                self.current_plan["current_phase_id"] = params.get("next_phase_id")
-                return json.dumps({
+                self.current_plan["current_phase_id"] = params.next_phase_id
+                return to_json({
                     "status": "success",
                     "message": "Advanced to next phase",
                     "current_phase_id": self.current_plan["current_phase_id"]
                 })
-            return json.dumps({"status": "error", "message": "No active plan"})
+            return to_json({"status": "error", "message": "No active plan"})
         
-        return json.dumps({"status": "error", "message": "Invalid action"})
+        return to_json({"status": "error", "message": "Invalid action"})
     
-    def execute_message(self, params: Dict[str, Any]) -> str:
+    async def execute_message(self, params: MessageInput) -> str:
         """
         Handle user messages
         """
-        msg_type = params.get("type")
-        text = params.get("text")
-        attachments = params.get("attachments", [])
+        msg_type = params.type
+        text = params.text
+        attachments = params.attachments
         
         print(f"\n[{msg_type.upper()}] {text}")
         
@@ -309,125 +782,276 @@ The default working language is English.
             print(f"Attachments: {', '.join(attachments)}")
         
         if msg_type == "ask":
-            # Get user input
-            user_input = input("\nYour response: ")
-            return json.dumps({"status": "success", "user_response": user_input})
+            # Get user input without blocking the event loop
+            user_input = await asyncio.to_thread(input, "\nYour response: ")
+            return to_json({"status": "success", "user_response": user_input})
         
-        return json.dumps({"status": "success", "message": "Message sent"})
+        return to_json({"status": "success", "message": "Message sent"})
     
-    def execute_shell(self, params: Dict[str, Any]) -> str:
+    async def execute_shell(self, params: ShellInput) -> str:
         """
-        Execute shell commands in Docker sandbox
+        Execute shell commands in the persistent Docker sandbox
         """
-        action = params.get("action")
+        action = params.action
+        session = params.session
         
         if action == "exec":
-            command = params.get("command")
-            timeout = params.get("timeout", 30)
+            command = params.command
+            timeout = params.timeout
+            max_output_bytes = params.max_output_bytes
             
             try:
-                # Run in Docker container
-                container = self.docker_client.containers.run(
-                    "ubuntu:22.04",
-                    command=f"bash -c '{command}'",
-                    detach=False,
-                    remove=True,
-                    mem_limit="512m",
-                    cpu_quota=100000,
-                    network_mode="bridge"
+                # Exec into the long-lived container; `timeout` bounds the
+                # command's wall-clock time inside the sandbox. The exec-form
+                # argv hands the command to bash verbatim, with no quoting
+                sandbox = await self.get_sandbox()
+                exec_inst = await sandbox.exec(
+                    ["timeout", str(timeout), "bash", "-c", command]
                 )
                 
-                output = container.decode() if isinstance(container, bytes) else str(container)
+                # Drain the stream into a bounded head + tail buffer so large
+                # output never accumulates in memory or the history
+                capture = OutputCapture(max_output_bytes)
                 
-                return json.dumps({
-                    "status": "success",
+                async def drain() -> int:
+                    async with exec_inst.start(detach=False) as stream:
+                        while (message := await stream.read_out()) is not None:
+                            capture.feed(message.data)
+                    return (await exec_inst.inspect())["ExitCode"]
+                
+                # Processes that escape `timeout` (setsid, daemons) can hold
+                # the stream open, so the agent also bounds its own wait
+                try:
+                    exit_code = await asyncio.wait_for(drain(), timeout + SHELL_TIMEOUT_GRACE)
+                except asyncio.TimeoutError:
+                    output = capture.getvalue()
+                    self.shell_sessions[session] = output
+                    return to_json({
+                        "status": "error",
+                        "message": f"Command did not finish within {timeout} seconds",
+                        "output": output,
+                        "truncated": capture.truncated
+                    })
+                
+                output = capture.getvalue()
+                self.shell_sessions[session] = output
+                
+                return to_json({
+                    "status": "success" if exit_code == 0 else "error",
                     "output": output,
-                    "exit_code": 0
-                })
-            
-            except docker.errors.ContainerError as e:
-                return json.dumps({
-                    "status": "error",
-                    "output": e.stderr.decode(),
-                    "exit_code": e.exit_status
+                    "exit_code": exit_code,
+                    "truncated": capture.truncated
                 })
             
             except Exception as e:
-                return json.dumps({
+                return to_json({
                     "status": "error",
                     "message": str(e)
                 })
         
-        return json.dumps({"status": "error", "message": "Invalid action"})
+        elif action == "view":
+            if session in self.shell_sessions:
+                return to_json({
+                    "status": "success",
+                    "output": self.shell_sessions[session]
+                })
+            return to_json({"status": "error", "message": f"Unknown session: {session}"})
+        
+        return to_json({"status": "error", "message": "Invalid action"})
     
-    def execute_file(self, params: Dict[str, Any]) -> str:
+    async def execute_file(self, params: FileInput) -> str:
         """
-        Handle file operations
+        Handle file operations on a worker thread, off the event loop
         """
-        action = params.get("action")
-        path = params.get("path")
+        return await asyncio.to_thread(self.run_file_operation, params)
+    
+    def run_file_operation(self, params: FileInput) -> str:
+        """
+        Perform a file operation with blocking I/O
+        """
+        action = params.action
+        path = params.path
         
         try:
             if action == "read":
-                with open(path, "r") as f:
-                    content = f.read()
-                return json.dumps({
+                offset = params.offset
+                length = params.length
+                
+                # Read only the requested byte range
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    size = os.fstat(fd).st_size
+                    data = os.pread(fd, length, offset)
+                finally:
+                    os.close(fd)
+                
+                # Hold back a multi-byte character split at the page end so
+                # next_offset always lands on a character boundary
+                end = offset + len(data)
+                decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+                content = decoder.decode(data, final=end >= size)
+                end -= len(decoder.getstate()[0])
+                
+                result = {
                     "status": "success",
                     "content": content,
-                    "path": path
-                })
+                    "path": path,
+                    "offset": offset,
+                    "end": end,
+                    "size": size,
+                    "sha256": hashlib.sha256(data[:end - offset]).hexdigest()
+                }
+                if end < size:
+                    result["next_offset"] = end
+                return to_json(result)
             
             elif action == "write":
-                text = params.get("text", "")
-                os.makedirs(os.path.dirname(path), exist_ok=True)
-                with open(path, "w") as f:
-                    f.write(text)
-                return json.dumps({
+                text = params.text
+                # Only create each parent directory once per agent
+                directory = os.path.dirname(path)
+                if directory and directory not in self._ensured_dirs:
+                    os.makedirs(directory, exist_ok=True)
+                    self._ensured_dirs.add(directory)
+                with open(path, "w", buffering=FILE_CHUNK_SIZE) as f:
+                    write_chunked(f, text)
+                return to_json({
                     "status": "success",
                     "message": f"File written: {path}"
                 })
             
             elif action == "append":
-                text = params.get("text", "")
-                with open(path, "a") as f:
-                    f.write(text)
-                return json.dumps({
+                text = params.text
+                with open(path, "a", buffering=FILE_CHUNK_SIZE) as f:
+                    write_chunked(f, text)
+                return to_json({
                     "status": "success",
                     "message": f"Content appended to: {path}"
                 })
             
             elif action == "edit":
-                edits = params.get("edits", [])
+                edits = params.edits
                 with open(path, "r") as f:
                     content = f.read()
                 
-                for edit in edits:
-                    content = content.replace(edit["find"], edit["replace"])
+                content, warnings = apply_edits(content, edits)
                 
                 with open(path, "w") as f:
                     f.write(content)
                 
-                return json.dumps({
+                result = {
                     "status": "success",
                     "message": f"File edited: {path}"
-                })
+                }
+                if warnings:
+                    result["warnings"] = warnings
+                return to_json(result)
             
-            return json.dumps({"status": "error", "message": "Invalid action"})
+            return to_json({"status": "error", "message": "Invalid action"})
         
         except Exception as e:
-            return json.dumps({
+            return to_json({
                 "status": "error",
                 "message": str(e)
             })
     
-    def run(self, user_message: str, max_iterations: int = 50) -> str:
+    async def compact_history(self):
+        """
+        Replace the older conversation turns with a summary, keeping the most
+        recent turns that fit in half of the history budgets
+        """
+        # History is the task message followed by (assistant, tool result)
+        # turn pairs
+        turns = (len(self.conversation_history) - 1) // 2
+        sizes = [len(msgspec.json.encode(message)) for message in self.conversation_history]
+        
+        # Keep recent turns by size rather than count: a turn may carry several
+        # large results, and a retained tail over budget on its own would make
+        # every compaction pointless. The last turn is always kept verbatim
+        byte_limit = self.history_byte_budget // 2
+        if self.history_tokens:
+            byte_limit = min(
+                byte_limit,
+                self.history_bytes * self.history_token_budget // (2 * self.history_tokens)
+            )
+        keep = 0
+        retained_bytes = 0
+        while keep < min(turns, max(self.keep_recent_turns, turns - turns // 2)):
+            turn_bytes = sizes[-2 * keep - 1] + sizes[-2 * keep - 2]
+            if keep and retained_bytes + turn_bytes > byte_limit:
+                break
+            retained_bytes += turn_bytes
+            keep += 1
+        
+        count = turns - keep
+        if count <= 0:
+            return
+        
+        cut = 1 + 2 * count
+        
+        response = await self.client.messages.create(
+            model=self.model,
+            max_tokens=2048,
+            system=SUMMARY_PROMPT,
+            messages=[{
+                "role": "user",
+                "content": format_transcript(itertools.islice(self.conversation_history, cut))
+            }]
+        )
+        summary = "".join(block.text for block in response.content if block.type == "text")
+        
+        print(f"\nSummarized {count} turns of history")
+        
+        # Keep the original task and fold the summary into the first message;
+        # the retained history resumes with an assistant turn
+        for _ in range(cut):
+            self.conversation_history.popleft()
+        self.conversation_history.appendleft({
+            "role": "user",
+            "content": f"{self.task}\n\n<progress_summary>\n{summary}\n</progress_summary>"
+        })
+        self.history_tokens = 0
+        self.history_bytes = sum(
+            len(msgspec.json.encode(message)) for message in self.conversation_history
+        )
+    
+    def append_history(self, message: Dict[str, Any]):
+        """
+        Append a message to the conversation and track its serialized size
+        """
+        self.conversation_history.append(message)
+        self.history_bytes += len(msgspec.json.encode(message))
+    
+    def get_cached_messages(self) -> List[Dict[str, Any]]:
+        """
+        Return the conversation history with a cache breakpoint on the latest
+        turn, so each iteration reuses the previously cached history prefix
+        """
+        messages = list(self.conversation_history)
+        last = messages[-1]
+        content = last["content"]
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        # Copy the final block so the breakpoint never leaks into the stored
+        # history (the API allows at most four breakpoints per request)
+        content = list(content[:-1]) + [
+            {**content[-1], "cache_control": {"type": "ephemeral"}}
+        ]
+        messages[-1] = {"role": last["role"], "content": content}
+        return messages
+
+    async def run(self, user_message: str, max_iterations: int = 50) -> str:
         """
         Main agent loop
         """
+        # Refresh the date block; the cached prompt block is unchanged
+        self._system_prompt = self.get_system_prompt()
+        
         # Initialize conversation
-        self.conversation_history = [
-            {"role": "user", "content": user_message}
-        ]
+        self.task = user_message
+        self.conversation_history = collections.deque()
+        self.history_tokens = 0
+        self.history_bytes = 0
+        self.append_history({"role": "user", "content": user_message})
         
         iteration = 0
         
@@ -437,17 +1061,66 @@ The default working language is English.
             print(f"Iteration {iteration}")
             print(f"{'='*60}")
             
-            # Call Claude API
-            response = self.client.messages.create(
+            if (self.history_tokens > self.history_token_budget
+                    or self.history_bytes > self.history_byte_budget):
+                await self.compact_history()
+            
+            # Stream Claude's response (prompt caching enabled) and dispatch
+            # the tool as soon as its input block completes, overlapping
+            # execution with the remainder of the generation
+            tool_calls = []
+            dispatched = []
+            raw_inputs = {}
+            async with self.client.beta.prompt_caching.messages.stream(
                 model=self.model,
                 max_tokens=self.max_tokens,
-                system=self.get_system_prompt(),
-                tools=self.get_tools(),
-                messages=self.conversation_history
+                system=self._system_prompt,
+                tools=self._tools,
+                messages=self.get_cached_messages()
+            ) as stream:
+                async for event in stream:
+                    # Keep the raw tool input JSON so it can be decoded
+                    # straight into the tool's typed input
+                    if (event.type == "content_block_delta"
+                            and event.delta.type == "input_json_delta"):
+                        raw_inputs.setdefault(event.index, []).append(event.delta.partial_json)
+                    
+                    elif (event.type == "content_block_stop"
+                            and event.content_block.type == "tool_use"):
+                        tool_use = event.content_block
+                        print(f"\nTool: {tool_use.name}")
+                        print(f"Input: {orjson.dumps(tool_use.input, option=orjson.OPT_INDENT_2).decode()}")
+                        
+                        # Calls on the same resource run in order; the rest
+                        # run concurrently
+                        raw_input = "".join(raw_inputs.get(event.index, ())) or "{}"
+                        resource = asyncio.ensure_future(
+                            self.get_resource_key(tool_use.name, tool_use.input)
+                        )
+                        tool_task = asyncio.create_task(self.execute_after(
+                            resource, list(dispatched), tool_use.name, raw_input
+                        ))
+                        dispatched.append((resource, tool_task))
+                        tool_calls.append((tool_use, tool_task))
+                
+                response = await stream.get_final_message()
+            
+            # Prompt size of this call approximates the next one's history
+            usage = response.usage
+            self.history_tokens = (
+                usage.input_tokens
+                + (usage.cache_creation_input_tokens or 0)
+                + (usage.cache_read_input_tokens or 0)
+                + usage.output_tokens
             )
             
             print(f"\nStop Reason: {response.stop_reason}")
             
+            # Tools dispatched from an unfinished turn are not acted upon
+            if response.stop_reason != "tool_use":
+                for _, tool_task in tool_calls:
+                    tool_task.cancel()
+            
             # Check if task is complete
             if response.stop_reason == "end_turn":
                 print("\nTask completed (no tool use)")
@@ -455,31 +1128,23 @@ The default working language is English.
             
             # Process tool use
             if response.stop_reason == "tool_use":
-                # Find tool use block
-                tool_use = None
-                for block in response.content:
-                    if block.type == "tool_use":
-                        tool_use = block
-                        break
-                
-                if not tool_use:
+                if not tool_calls:
                     print("No tool use found in response")
                     break
                 
-                print(f"\nTool: {tool_use.name}")
-                print(f"Input: {json.dumps(tool_use.input, indent=2)}")
-                
-                # Execute tool
-                result = self.execute_tool(tool_use.name, tool_use.input)
-                print(f"\nResult: {result}")
+                # Wait for every tool dispatched during streaming
+                results = await asyncio.gather(*(task for _, task in tool_calls))
+                for result in results:
+                    print(f"\nResult: {result}")
                 
-                # Add to conversation history
-                self.conversation_history.append({
+                # Add to conversation history as plain dicts so the SDK's
+                # response objects can be freed; all results go in one turn
+                self.append_history({
                     "role": "assistant",
-                    "content": response.content
+                    "content": [block.to_dict() for block in response.content]
                 })
                 
-                self.conversation_history.append({
+                self.append_history({
                     "role": "user",
                     "content": [
                         {
@@ -487,13 +1152,15 @@ The default working language is English.
                             "tool_use_id": tool_use.id,
                             "content": result
                         }
+                        for (tool_use, _), result in zip(tool_calls, results)
                     ]
                 })
                 
-                # Check if this was a result message (task complete)
-                if tool_use.name == "message" and tool_use.input.get("type") == "result":
-                    print("\n✓ Task completed successfully!")
-                    return tool_use.input.get("text")
+                # Check if a result message was sent (task complete)
+                for tool_use, _ in tool_calls:
+                    if tool_use.name == "message" and tool_use.input.get("type") == "result":
+                        print("\n✓ Task completed successfully!")
+                        return tool_use.input.get("text")
                 
                 # Check error count
                 if self.error_count >= self.max_errors:
@@ -510,7 +1177,7 @@ The default working language is English.
         return "Task incomplete or error occurred"
 
 
-def main():
+async def main():
     """
     Example usage
     """
@@ -520,9 +1187,6 @@ def main():
         print("Error: CLAUDE_API_KEY environment variable not set")
         return
     
-    # Create agent
-    agent = ManusAgent(api_key)
-    
     # Example tasks
     tasks = [
         "Create a Python script that calculates the first 10 Fibonacci numbers",
@@ -538,7 +1202,9 @@ def main():
     task = tasks[0]  # Change index to try different tasks
     print(f"\nTask: {task}\n")
     
-    result = agent.run(task)
+    # Create agent; the context manager starts and tears down the sandbox
+    async with ManusAgent(api_key) as agent:
+        result = await agent.run(task)
     
     print("\n" + "="*60)
     print("FINAL RESULT")
@@ -547,4 +1213,7 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())